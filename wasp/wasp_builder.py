@@ -2,6 +2,9 @@
 from __future__ import annotations
 
 import argparse
+import mmap
+import os
+import shutil
 import struct
 import json
 from urllib.parse import urlparse
@@ -13,53 +16,63 @@ from typing import NamedTuple, Optional, Dict, Tuple
 from pathlib import Path
 
 import constants
+from wasp_cipher import xor_with_key
 
-# This comes from the "SimplePassword" class in libse1linux (0fe1248ecab199bee383cef69f2de77d33b269ad1664127b366a4e745b1199c8)
-cypher_bytes = b'\xf7\xe0\xc9\xb2\x9b\x84\x6d\x56\x3f\x28\x11\xf9\xe2\xcb\xb4\x9d\x86\x6f\x58\x41\x2a\x13\xfb\xe4\xcd\xb6\x9f\x88\x71\x5a\x43\x2c\x15\xfd\xe6\xcf\xb8\xa1\x8a\x73\x5c\x45\x2e\x17\x00\xe8\xd1\xba\xa3\x8c\x75\x5e\x47\x30\x19\x02\xea\xd3\xbc\xa5\x8e\x77\x60\x49\x32\x1b\x04\xec\xd5\xbe\xa7\x90\x79\x62\x4b\x34\x1d\x06\xee\xd7\xc0\xa9\x92\x7b\x64\x4d\x36\x1f\x08\xf0\xd9\xc2\xab\x94\x7d\x66\x4f\x38\x21\x0a\xf2\xdb\xc4\xad\x96\x7f\x68\x51\x3a\x23\x0c\xf4\xdd\xc6\xaf\x98\x81\x6a\x53\x3c\x25\x0e\xf6\xdf\xc8\xb1\x9a\x83\x6c\x55\x3e\x27\x10\xf8\xe1\xca\xb3\x9c\x85\x6e\x57\x40\x29\x12\xfa\xe3\xcc\xb5\x9e\x87\x70\x59\x42\x2b\x14\xfc\xe5\xce\xb7\xa0\x89\x72\x5b\x44\x2d\x16\xfe\xe7\xd0\xb9\xa2\x8b\x74\x5d\x46\x2f\x18\x01\xe9\xd2\xbb\xa4\x8d\x76\x5f\x48\x31\x1a\x03\xeb\xd4\xbd\xa6\x8f\x78\x61\x4a\x33\x1c\x05\xed\xd6\xbf\xa8\x91\x7a\x63\x4c\x35\x1e\xef\xd8\xc1\xaa\x93\x7c\x65\x4e\x37\x20\x09\xf1\xda\xc3\xac\x95\x7e\x67\x50\x39\x22\x0b\xf3\xdc\xc5\xae\x97\x80\x69\x52\x3b\x24\x0d\xf5\xde\xc7\xb0\x99\x82\x6b\x54\x3d\x26\x0f\xf7'
+# The config footer starts with a `nu11` magic, the config length and a second `nu11` magic
+config_header_struct = struct.Struct('!4sI4s')
+# The encrypted config is padded out so the header and config fill the 255 byte footer
+config_footer_struct = struct.Struct(f'{255 - config_header_struct.size}s')
 
 class WaspBuildConfiguration(object):
     """ A particular build of a Wasp """
-    beacon_url: str
-    backup_beacon_url: str
+    beacon_hostname: str
+    beacon_port: int
+    backup_beacon_hostname: str
+    backup_beacon_port: int
 
     def __init__(
             self,
-            beacon_url: str,
-            backup_beacon_url: Optional[str],
+            beacon_hostname: str,
+            beacon_port: int,
+            backup_beacon_hostname: Optional[str] = None,
+            backup_beacon_port: Optional[int] = None,
             ) -> None:
-        self.beacon_url = beacon_url
-        if backup_beacon_url:
-            self.backup_beacon_url = backup_beacon_url
+        self.beacon_hostname = beacon_hostname
+        self.beacon_port = beacon_port
+        if backup_beacon_hostname:
+            self.backup_beacon_hostname = backup_beacon_hostname
+            self.backup_beacon_port = backup_beacon_port if backup_beacon_port is not None else beacon_port
         else:
-            self.backup_beacon_url = beacon_url
-
-    @property
-    def beacon_hostname(self) -> str:
-        hostname = urlparse(self.beacon_url).hostname
-        if hostname is None:
-            raise ValueError("Beacon URL must have a hostname")
-        return hostname
+            self.backup_beacon_hostname = beacon_hostname
+            self.backup_beacon_port = beacon_port
 
     @property
-    def beacon_port(self) -> int:
-        port = urlparse(self.beacon_url).port
-        if port is None:
-            raise ValueError("Beacon URL must have a port")
-        return port
+    def beacon_url(self) -> str:
+        return f"wasp://{self.beacon_hostname}:{self.beacon_port}"
 
     @property
-    def backup_beacon_hostname(self) -> str:
-        hostname = urlparse(self.backup_beacon_url).hostname
-        if hostname is None:
-            raise ValueError("Backup beacon URL must have a hostname")
-        return hostname
+    def backup_beacon_url(self) -> str:
+        return f"wasp://{self.backup_beacon_hostname}:{self.backup_beacon_port}"
+
+    @staticmethod
+    def parse_beacon_url(url: str, description: str) -> Tuple[str, int]:
+        """ Split a wasp://<hostname>:<port> URL into its hostname and port """
+        parsed = urlparse(url)
+        if parsed.hostname is None:
+            raise ValueError(f"{description} URL must have a hostname")
+        if parsed.port is None:
+            raise ValueError(f"{description} URL must have a port")
+        return parsed.hostname, parsed.port
 
-    @property
-    def backup_beacon_port(self) -> int:
-        port = urlparse(self.backup_beacon_url).port
-        if port is None:
-            raise ValueError("Backup beacon URL must have a port")
-        return port
+    @classmethod
+    def from_urls(cls, beacon_url: str, backup_beacon_url: Optional[str] = None) -> WaspBuildConfiguration:
+        """ Create a WaspBuildConfiguration from wasp://<hostname>:<port> URLs """
+        beacon_hostname, beacon_port = cls.parse_beacon_url(beacon_url, "Beacon")
+        if backup_beacon_url:
+            backup_beacon_hostname, backup_beacon_port = cls.parse_beacon_url(backup_beacon_url, "Backup beacon")
+        else:
+            backup_beacon_hostname, backup_beacon_port = beacon_hostname, beacon_port
+        return cls(beacon_hostname, beacon_port, backup_beacon_hostname, backup_beacon_port)
 
     @classmethod
     def from_json(cls, json_string: str | bytes) -> WaspBuildConfiguration:
@@ -70,17 +83,16 @@ class WaspBuildConfiguration(object):
     def from_dict(cls, json: Dict) -> WaspBuildConfiguration:
         """ Create a WaspBuildConfiguration from a dictionary """
         try:
+            # Prefer the domain, but the original samples only carry an IP
             primary: Dict = json["Master"]
-            domain: str = primary.get("Domain", primary["IP"])
+            domain: str = primary["Domain"] if "Domain" in primary else primary["IP"]
             port: int = primary["Port"]
-            beacon_url: str = f"wasp://{domain}:{port}"
 
             backup: Dict = json["Standby"]
-            domain: str = backup.get("Domain", backup["IP"])
-            port: int = backup["Port"]
-            backup_beacon_url:str = f"wasp://{domain}:{port}"
+            backup_domain: str = backup["Domain"] if "Domain" in backup else backup["IP"]
+            backup_port: int = backup["Port"]
 
-            return cls(beacon_url, backup_beacon_url)
+            return cls(domain, port, backup_domain, backup_port)
         except KeyError as e:
             raise ValueError(f"Invalid wasp configuration. Missing key {e.args}")
 
@@ -105,32 +117,43 @@ class WaspBuildConfiguration(object):
     def split_wasp(cls, wasp_path: Path | bytes) -> Tuple[bytes, WaspBuildConfiguration]:
         """ Given a wasp, split it into the header and the configuration """
         if isinstance(wasp_path, Path):
-            wasp_bytes = wasp_path.read_bytes()
-        else:
-            wasp_bytes = wasp_path
+            # Map the file so the magic search only pages in the tail rather than copying the whole binary
+            with wasp_path.open('rb') as wasp_file, mmap.mmap(wasp_file.fileno(), 0, access=mmap.ACCESS_READ) as wasp_map:
+                return cls._split_wasp_buffer(wasp_map)
+        return cls._split_wasp_buffer(wasp_path)
 
+    @classmethod
+    def _split_wasp_buffer(cls, wasp_bytes: bytes | mmap.mmap) -> Tuple[bytes, WaspBuildConfiguration]:
+        """ Split a wasp held in memory (or mapped) into the header and the configuration """
         magic = b'nu11'
 
-        second_null = wasp_bytes.rfind(magic)
-        first_null = wasp_bytes.rfind(magic, 0, second_null)
-        header_start = first_null
-
-        header_len = len(magic) + 4 + len(magic)
-        size = header_len + 255
+        # The last magic is the second one in the header, so the header starts a magic and a length before it
+        header_len = config_header_struct.size
+        header_start = wasp_bytes.rfind(magic) - (header_len - len(magic))
+        if header_start < 0:
+            raise ValueError("No wasp configuration found")
+        first_null, size, second_null = config_header_struct.unpack_from(wasp_bytes, header_start)
+        if first_null != magic:
+            raise ValueError("No wasp configuration found")
         config_footer = wasp_bytes[header_start:]
-        null, size, null = struct.unpack('!4sI4s', config_footer[:header_len])
         config_blob = struct.unpack(f'{size}s', config_footer[header_len:header_len+size])[0]
-        decrypted_config_json = b''
-        for index, b in enumerate(config_blob):
-            # Not sure if the real implementation does the modulo
-            decrypted_config_json += struct.pack("B", (config_blob[index] ^ cypher_bytes[index % len(cypher_bytes)]))
-        config_json = json.loads(decrypted_config_json.decode('utf-8'))
-        return wasp_bytes[:header_start], cls.from_dict(config_json)
+        # Not sure if the real implementation repeats the key
+        decrypted_config_json = xor_with_key(config_blob)
+        return wasp_bytes[:header_start], cls.from_json(decrypted_config_json)
 
     @classmethod
     def config_from_wasp(cls, wasp_path: Path) -> WaspBuildConfiguration:
         """ Extract the configuration from a wasp """
-        return cls.split_wasp(wasp_path)[1]
+        # The config footer is written last, so the end of the file is usually all we need to read
+        with wasp_path.open('rb') as wasp_file:
+            wasp_file.seek(0, os.SEEK_END)
+            wasp_file.seek(max(0, wasp_file.tell() - 512))
+            tail = wasp_file.read()
+        try:
+            return cls._split_wasp_buffer(tail)[1]
+        except (ValueError, struct.error):
+            # Something follows the footer, fall back to searching the whole file
+            return cls.split_wasp(wasp_path)[1]
 
     def build_wasp(
             self,
@@ -139,37 +162,29 @@ class WaspBuildConfiguration(object):
             ) -> Path:
         """ Build a wasp with the given configuration and return the path to the built wasp """
 
-        if base_wasp_path:
-            base_bytes = base_wasp_path.read_bytes()
-        else:
-            base_bytes = constants.WASP_BASE_BUILD.read_bytes()
+        base_path = base_wasp_path or constants.WASP_BASE_BUILD
 
         config_json = self.to_json().encode('utf-8')
 
-        # TODO: Use the common cipher method from the comms module
-        encrypted_config_json = b''
-        for index, b in enumerate(config_json):
-            # Not sure if the real implementation does the modulo
-            encrypted_config_json += struct.pack("B", (config_json[index] ^ cypher_bytes[index % len(cypher_bytes)]))
+        # Not sure if the real implementation repeats the key
+        encrypted_config_json = xor_with_key(config_json)
 
         # Pack a struct with the flags, config length, config
         flags = 0
         config_length = len(config_json)
         magic = b'nu11'
-        header_len = len(magic) + 4 + len(magic)
-        footer_size = 255 - header_len
 
         """
         The final structure is:
         4 byte magic (`nu11`)
         4 byte config length
         4 byte magic (`nu11`)
-        255 byte footer containing `footer_size` bytes of JSON followed by arbitrary bytes (`\x00` in the original sample)
+        255 byte footer containing `config_footer_struct.size` bytes of JSON followed by arbitrary bytes (`\x00` in the original sample)
         """
         # TODO: Replace the padding with data from earlier in the binary to obfuscate it from a cursory glance
         # TODO: Replace the magic with our own value
 
-        wasp_config_struct = magic + struct.pack('!I', config_length) + magic + struct.pack(f'{footer_size}s', encrypted_config_json)
+        wasp_config_struct = config_header_struct.pack(magic, config_length, magic) + config_footer_struct.pack(encrypted_config_json)
 
         # if the user did not specify an output path, we'll generate one
         if not output_path:
@@ -177,7 +192,10 @@ class WaspBuildConfiguration(object):
             output_path = constants.WASP_BUILDS_PATH / f"wasp-{date_str}"
         output_path.parent.mkdir(parents=True, exist_ok=True)
 
-        output_path.write_bytes(base_bytes + wasp_config_struct)
+        # Copy the base across in blocks rather than holding it (and a concatenated copy) in memory
+        with base_path.open('rb') as base_file, output_path.open('wb') as output_file:
+            shutil.copyfileobj(base_file, output_file)
+            output_file.write(wasp_config_struct)
         Path(str(output_path) + ".config.json").write_bytes(config_json)
         return output_path
 
@@ -197,19 +215,18 @@ def main():
     parser.add_argument("OUTPUT_FILE", help="The file to save the config", type=Path)
     args = parser.parse_args()
 
-    # Read the base file to hide in
-    base_bytes: bytes = args.base_file.read_bytes()
-
     if args.unpack:
         # Extract the config and save it
-        header, config = WaspBuildConfiguration.split_wasp(base_bytes)
+        header, config = WaspBuildConfiguration.split_wasp(args.base_file)
         if args.strip_config:
             args.OUTPUT_FILE.write_bytes(header)
         else:
             args.OUTPUT_FILE.write_bytes(config.to_json().encode('utf-8'))
-        
-    if not args.unpack:
+    else:
         # Generate our configuration
-        config = WaspBuildConfiguration(args.beacon_url, args.backup_beacon_url)
+        config = WaspBuildConfiguration.from_urls(args.beacon_url, args.backup_beacon_url)
         # Build the wasp
         config.build_wasp(args.OUTPUT_FILE, args.base_file)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import functools
+from enum import Enum
+
+from constants import CIPHER_LENGTH, CIPHER_DOUBLED
+
+class WaspMethod(Enum):
+    SIMPLE_CIPHER = 1
+    EMPTY_CIPHER = 0
+
+@functools.lru_cache(maxsize=1024)
+def short_keystream_value(offset: int, length: int) -> int:
+    """ The keystream for a message no longer than the key, as an integer ready to XOR.
+    Length prefixes and commands recur, so their keystreams are cached """
+    return int.from_bytes(CIPHER_DOUBLED[offset:offset + length], 'big')
+
+def xor_with_key(data: bytes, offset: int = 0) -> bytes:
+    """ XOR data with the SimplePassword key, starting `offset` bytes into the key """
+    # Lay the key out to the length of the data, then XOR the whole buffer as one big integer
+    length = len(data)
+    if length <= CIPHER_LENGTH:
+        keystream_value = short_keystream_value(offset, length)
+    else:
+        keystream = (CIPHER_DOUBLED[offset:offset + CIPHER_LENGTH] * (length // CIPHER_LENGTH + 1))[:length]
+        keystream_value = int.from_bytes(keystream, 'big')
+    return (int.from_bytes(data, 'big') ^ keystream_value).to_bytes(length, 'big')
+
+class WaspCipher(object):
+    method: WaspMethod = WaspMethod.EMPTY_CIPHER
+    def cipher(self, data: bytes) -> bytes:
+        return data
+
+# The empty cipher holds no state, so every connection shares one
+null_cipher = WaspCipher()
+
+class WaspSimpleCipher(WaspCipher):
+    method: WaspMethod = WaspMethod.SIMPLE_CIPHER
+    offset: int = 0
+    def __init__(self, offset: int = 0) -> None:
+        self.offset = offset
+
+    def cipher(self, data: bytes) -> bytes:
+        encrypted_bytes = xor_with_key(data, self.offset)
+        self.offset = (self.offset + len(data)) % CIPHER_LENGTH
+        return encrypted_bytes
